@@ -0,0 +1,306 @@
+import numpy as np
+import sys
+from typing import Dict, List, Optional, Tuple
+
+from functions import load_vcf, extract_genotype_data, save_to_json, load_json_to_dict
+
+# https://scikit-allel.readthedocs.io/en/stable/stats/diversity.html
+# https://scikit-allel.readthedocs.io/en/stable/stats/fst.html
+#
+# Between-clade statistics for all clade pairs at once. Instead of calling
+# allel.sequence_divergence / allel.hudson_fst for each of the ~4000 pairs (one
+# genotype scan per pair), the per-clade allele counts are built once per chunk of
+# variants and every pair is obtained with matrix products:
+#   sum_v dxy_v(i, j) = sum_v V_i V_j - sum_v,a p_ia p_ja   (V = clade has called alleles)
+
+def build_clade_membership(sample_names: np.ndarray, clusters: Dict[str, List[str]]) -> Tuple[List[str], np.ndarray]:
+    """
+    Build the sample x clade membership matrix used to count alleles for all clades at once.
+
+    Args:
+        sample_names (np.ndarray): Sample names of the callset.
+        clusters (dict): A dictionary where keys are cluster numbers and values are lists of sample names.
+
+    Returns:
+        tuple: The ordered list of clade names and a (n_samples, n_clades) membership matrix.
+
+    Raises:
+        ValueError: If a sample name in the clusters is not found in the callset samples.
+    """
+    sample_index = {name: i for i, name in enumerate(sample_names)}
+    clade_names = list(clusters.keys())
+
+    membership = np.zeros((len(sample_names), len(clade_names)), dtype='i4')
+    for k, clade in enumerate(clade_names):
+        for sample in clusters[clade]:
+            if sample not in sample_index:
+                raise ValueError(f"Sample name '{sample}' in cluster '{clade}' is not found in the callset samples.")
+            membership[sample_index[sample], k] = 1
+
+    return clade_names, membership
+
+def count_clade_alleles(genotypes: np.ndarray, membership: np.ndarray, max_allele: int) -> np.ndarray:
+    """
+    Count alleles of every clade in a single pass over a chunk of genotypes.
+
+    Args:
+        genotypes (np.ndarray): Genotype data of shape (n_variants, n_samples, ploidy).
+        membership (np.ndarray): Sample x clade membership matrix.
+        max_allele (int): Highest allele index to count.
+
+    Returns:
+        np.ndarray: Allele counts of shape (n_clades, n_variants, n_alleles). Missing calls are not counted.
+    """
+    n_variants = genotypes.shape[0]
+    counts = np.empty((membership.shape[1], n_variants, max_allele + 1), dtype='f8')
+    for allele in range(max_allele + 1):
+        # (n_variants, n_samples) allele dosage, summed per clade with one product
+        dosage = (genotypes == allele).sum(axis=2, dtype='i4')
+        counts[:, :, allele] = (dosage @ membership).T
+
+    return counts
+
+def compute_divergence_sums(allele_counts: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Compute all-pairs sums over variants of dxy and of Hudson's Fst numerator.
+
+    Mirrors allel.mean_pairwise_difference_between and allel.hudson_fst: a variant
+    contributes to dxy (and the Fst denominator) if both clades have called alleles,
+    and to the Fst numerator if both clades have at least two called alleles.
+
+    Args:
+        allele_counts (np.ndarray): Allele counts of shape (n_clades, n_variants, n_alleles).
+
+    Returns:
+        tuple: Two (n_clades, n_clades) matrices: summed dxy (also the Fst denominator) and summed Fst numerator.
+    """
+    n_clades = allele_counts.shape[0]
+    an = allele_counts.sum(axis=2)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        freqs = np.where(an[:, :, None] > 0, allele_counts / an[:, :, None], 0)
+        # Unbiased within-clade mean pairwise difference (allel.mean_pairwise_difference)
+        within = (an ** 2 - (allele_counts ** 2).sum(axis=2)) / (an * (an - 1))
+
+    called = (an > 0).astype('f8')
+    flat_freqs = freqs.reshape(n_clades, -1)
+    dxy = called @ called.T - flat_freqs @ flat_freqs.T
+
+    # The numerator only uses variants where both within-clade values are defined
+    paired = (an > 1).astype('f8')
+    within = np.where(an > 1, within, 0)
+    paired_freqs = (freqs * paired[:, :, None]).reshape(n_clades, -1)
+    within_paired = within @ paired.T
+    num = paired @ paired.T - paired_freqs @ paired_freqs.T - (within_paired + within_paired.T) / 2
+
+    return dxy, num
+
+def compute_region_divergence(genotypes: np.ndarray, membership: np.ndarray, max_allele: int,
+                              chunk_size: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Accumulate all-pairs divergence sums over a region, processing the variants chunk by chunk.
+
+    Args:
+        genotypes (np.ndarray): Genotype data of the region.
+        membership (np.ndarray): Sample x clade membership matrix.
+        max_allele (int): Highest allele index to count.
+        chunk_size (int): Number of variants processed at once.
+
+    Returns:
+        tuple: Summed dxy and Fst numerator matrices of the region.
+    """
+    n_clades = membership.shape[1]
+    dxy = np.zeros((n_clades, n_clades))
+    num = np.zeros((n_clades, n_clades))
+
+    for start in range(0, genotypes.shape[0], chunk_size):
+        allele_counts = count_clade_alleles(genotypes[start:start + chunk_size], membership, max_allele)
+        chunk_dxy, chunk_num = compute_divergence_sums(allele_counts)
+        dxy += chunk_dxy
+        num += chunk_num
+
+    return dxy, num
+
+def normalise_divergence(dxy: np.ndarray, num: np.ndarray, n_bases: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Turn summed dxy and Fst numerator matrices of a region into per-base dxy and Hudson's Fst.
+
+    The diagonal (a clade against itself) is not a between-clade statistic and is set to NaN.
+    For within-clade diversity, use the unbiased π computed by pi.py.
+
+    Args:
+        dxy (np.ndarray): Summed dxy matrix of the region (also the Fst denominator).
+        num (np.ndarray): Summed Fst numerator matrix of the region.
+        n_bases (int): Number of bases covered by the region.
+
+    Returns:
+        tuple: The per-base dxy matrix and the Fst matrix.
+    """
+    with np.errstate(invalid='ignore', divide='ignore'):
+        dxy_per_base = dxy / n_bases
+        fst = num / dxy
+    np.fill_diagonal(dxy_per_base, np.nan)
+    np.fill_diagonal(fst, np.nan)
+
+    return dxy_per_base, fst
+
+def compute_clade_divergence(callset: Dict[str, np.ndarray], genotypes: np.ndarray, clusters: Dict[str, List[str]],
+                             window_size: Optional[int] = None, chunk_size: int = 10000) -> Dict[str, dict]:
+    """
+    Compute between-clade divergence (dxy) and Hudson's Fst for all clade pairs, for each contig
+    and optionally for each window of each contig.
+
+    As in allel.sequence_divergence, dxy is divided by the number of bases between the first and
+    the last variant of the contig. Fst is the ratio of the summed numerator and denominator
+    (allel.average_hudson_fst without blocks). Diagonal entries are NaN.
+
+    Windows are 1-based and inclusive, start at position 1 and tile the contig up to its last
+    variant; the last window is clipped to that variant, as in allel.windowed_divergence. Window
+    dxy is divided by the number of bases the window covers. In windowed mode the contig values
+    are the sums of the window values, so the genotypes are only counted once.
+
+    Args:
+        callset (dict): Callset containing VCF data.
+        genotypes (np.ndarray): Genotype data.
+        clusters (dict): A dictionary where keys are cluster numbers and values are lists of sample names.
+        window_size (Optional[int]): Window size in bases. If None, only contig-wide values are computed.
+        chunk_size (int): Number of variants processed at once.
+
+    Returns:
+        dict: A dictionary with the ordered 'clades' list and, for 'dxy', 'fst' (and 'windows' if a window
+              size is given), contig names as keys and clade x clade matrices as values.
+
+    Raises:
+        RuntimeError: If there is an error computing the divergence.
+        ValueError: If a sample name in the clusters is not found in the callset samples.
+    """
+    try:
+        contig_names = callset['variants/CHROM']
+        variants_pos = callset['variants/POS']
+        unique_contigs = np.unique(contig_names)
+
+        clade_names, membership = build_clade_membership(callset['samples'], clusters)
+        max_allele = max(int(genotypes.max()), 1)
+
+        results = {'clades': clade_names, 'dxy': {}, 'fst': {}}
+        if window_size is not None:
+            results['windows'] = {}
+
+        for contig in unique_contigs:
+            # Create a mask to filter positions and genotypes specific to the current contig
+            contig_mask = (contig_names == contig)
+            contig_positions = variants_pos[contig_mask]
+            contig_genotypes = genotypes[contig_mask]
+
+            if window_size is None:
+                dxy, num = compute_region_divergence(contig_genotypes, membership, max_allele, chunk_size)
+            else:
+                # The windows cover every variant of the contig, so the contig sums are accumulated from them
+                n_clades = membership.shape[1]
+                dxy = np.zeros((n_clades, n_clades))
+                num = np.zeros((n_clades, n_clades))
+                last_position = contig_positions[-1]
+
+                contig_windows = {}
+                for window_start in range(1, last_position + 1, window_size):
+                    window_stop = min(window_start + window_size - 1, last_position)
+                    # Positions are sorted within a contig, so each window is a contiguous slice
+                    first, last = np.searchsorted(contig_positions, [window_start, window_stop + 1])
+                    if first == last:
+                        continue
+                    window_dxy, window_num = compute_region_divergence(contig_genotypes[first:last], membership,
+                                                                       max_allele, chunk_size)
+                    dxy += window_dxy
+                    num += window_num
+
+                    window_dxy, window_fst = normalise_divergence(window_dxy, window_num, window_stop - window_start + 1)
+                    contig_windows[f"{window_start}-{window_stop}"] = {
+                        'dxy': window_dxy.tolist(),
+                        'fst': window_fst.tolist()
+                    }
+                results['windows'][contig] = contig_windows
+
+            n_bases = contig_positions[-1] - contig_positions[0] + 1
+            dxy, fst = normalise_divergence(dxy, num, n_bases)
+            results['dxy'][contig] = dxy.tolist()
+            results['fst'][contig] = fst.tolist()
+
+        return results
+
+    except ValueError as ve:
+        raise ve
+    except Exception as e:
+        raise RuntimeError(f"Error computing clade divergence: {e}")
+
+def add_genome_wide_divergence(results: Dict[str, dict], weights: Dict[str, float]) -> Dict[str, dict]:
+    """
+    Adds a 'genome-wide' matrix to the dxy and Fst results, weighting each contig by the chromosome size.
+
+    dxy is the weighted mean of the contig matrices. Fst is computed as a ratio of weighted means,
+    using dxy as the per-base denominator and Fst * dxy as the per-base numerator. Diagonal entries are NaN.
+
+    Parameters:
+    results (dict): Output of compute_clade_divergence.
+    weights (dict): A dictionary where keys are contig names and values are the weights associated with each contig.
+
+    Returns:
+    dict: The input dictionary with the 'genome-wide' key added to the 'dxy' and 'fst' entries.
+    """
+    n_clades = len(results['clades'])
+    weighted_num = np.zeros((n_clades, n_clades))
+    weighted_den = np.zeros((n_clades, n_clades))
+    total_weight = 0
+
+    for contig, dxy in results['dxy'].items():
+        if contig not in weights:
+            continue
+        weight = weights[contig]
+        dxy = np.asarray(dxy, dtype='f8')
+        fst = np.asarray(results['fst'][contig], dtype='f8')
+        weighted_den += np.nan_to_num(dxy) * weight
+        weighted_num += np.nan_to_num(fst * dxy) * weight
+        total_weight += weight
+
+    if total_weight > 0:
+        genome_wide_dxy = weighted_den / total_weight
+    else:
+        genome_wide_dxy = np.zeros((n_clades, n_clades))  # or handle case where there are no valid weights
+    with np.errstate(invalid='ignore', divide='ignore'):
+        genome_wide_fst = weighted_num / weighted_den
+    np.fill_diagonal(genome_wide_dxy, np.nan)
+    np.fill_diagonal(genome_wide_fst, np.nan)
+
+    results['dxy']['genome-wide'] = genome_wide_dxy.tolist()
+    results['fst']['genome-wide'] = genome_wide_fst.tolist()
+
+    return results
+
+def main():
+
+    if len(sys.argv) < 4:
+        print("Usage: python script.py <vcf_file> <clade_file_dict> <chromosome_size_dict> [window_size]")
+        sys.exit(1)
+
+    vcf_file = sys.argv[1]
+    clade_dict = sys.argv[2]
+    chr_dict = sys.argv[3]
+    window_size = int(sys.argv[4]) if len(sys.argv) > 4 else None
+
+    json_output_file = "divergence.json"
+
+    # Load the file and extract the genotypes
+    callset = load_vcf(vcf_file)
+    genotypes = extract_genotype_data(callset)
+
+    # Compute dxy and Fst for all clade pairs
+    clades = load_json_to_dict(clade_dict)
+    results = compute_clade_divergence(callset, genotypes, clades, window_size)
+
+    # Compute genome-wide values (weigthed by chromosome size)
+    chr_size = load_json_to_dict(chr_dict)
+    results = add_genome_wide_divergence(results, chr_size)
+
+    # Save results to JSON
+    save_to_json(results, json_output_file)
+
+if __name__ == "__main__":
+    main()
@@ -17,6 +17,7 @@ chr_size='/shared/projects/yeast_neutral_model/vcf/data/chromsome_sizes.json'
 
 python3 pi.py $vcf $clade $chr_size
 # python3 D.py $vcf $clade
+# python3 dxy.py $vcf $clade $chr_size
 # python3 W.py $vcf
 # python3 het_variant.py $vcf
 # other sumstats 